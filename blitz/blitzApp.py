@@ -2,6 +2,8 @@ from telegram import Update
 from telegram.ext import CommandHandler, MessageHandler, PollAnswerHandler, CallbackQueryHandler, CallbackContext, filters
 from telegram.ext._contexttypes import ContextTypes
 from fastapi import Request, Response
+from typing import Optional
+import asyncio
 import json
 
 from utils import get_config
@@ -9,10 +11,13 @@ import controllers
 import nlp
 
 DEBUG_MODE = True
+# Off when load testing locally, there is no public endpoint or certfile to register
+REGISTER_WEBHOOK = True
 
 endpoint = get_config('endpoint')
 webhook_url = f'https://{get_config("ip")}{endpoint}'
 bot = controllers.app
+compaction_task: Optional[asyncio.Task] = None
 
 async def command_start(update: Update, _: ContextTypes.DEFAULT_TYPE):
     start_msg_lines = [
@@ -39,6 +44,7 @@ async def command_help(update: Update, context: CallbackContext):
         '/alltrips - Shows you all the trips that you have logged with me!',
         '/bill AMOUNT DESC - Record a receipt that you paid for, I will later ask who you paid for',
         '/settle - Get the final amout everyone owes each other',
+        '/close - Close the current trip once everyone has settled up',
         '/receipts - Shows all receipts and breakdown',
         '/show - Shows the currnet trip you are on, you can reselect older trips',
         '/intro - Tell you more about myself!',
@@ -116,6 +122,9 @@ async def poll_complete_bill(update: Update, context: CallbackContext):
 async def command_settle(update: Update, context: CallbackContext):
     await controllers.settle(update, context)
 
+async def command_close_trip(update: Update, context: CallbackContext):
+    await controllers.close_trip(update, context)
+
 async def command_show_receipts(update: Update, context: CallbackContext):
     await controllers.show_receipts(update, context)
 
@@ -140,6 +149,7 @@ command_map = {
     'trip': command_trip,
     'bill': command_bill,
     'settle': command_settle,
+    'close': command_close_trip,
     'explain': command_explain,
     'show': command_show_trip,
     'receipts': command_show_receipts,
@@ -176,6 +186,10 @@ async def handle_text(update: Update, context: CallbackContext):
         await update.message.reply_text(str(e))
 
 async def setup():
+    global compaction_task
+    controllers.ensure_indexes()
+    compaction_task = asyncio.create_task(controllers.compaction_loop())
+
     for command, func in command_map.items():
         bot.add_handler(CommandHandler(command, func))
 
@@ -189,9 +203,22 @@ async def setup():
         bot.add_handler(PollAnswerHandler(func))
 
     bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    if controllers.MODE == 'polling':
+        # The updater removes the webhook itself when polling starts
+        return
+    if not REGISTER_WEBHOOK:
+        return
     with open(get_config('certfile')) as certfile:
         await bot.bot.setWebhook(webhook_url)
 
+async def shutdown():
+    if compaction_task is None: return
+    compaction_task.cancel()
+    try:
+        await compaction_task
+    except asyncio.CancelledError:
+        pass
+
 async def process_request(request: Request):
     req = await request.json()
     if DEBUG_MODE: print(json.dumps(req, indent=2))
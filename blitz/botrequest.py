@@ -0,0 +1,93 @@
+from telegram.request import HTTPXRequest
+from utils import get_config
+
+from collections import deque
+from typing import Deque, Dict, Iterable, Tuple
+import asyncio
+import json
+import math
+import time
+import httpx
+
+RECENT_SAMPLES = 1000
+
+def percentile(samples: Iterable[float], pct: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+class EndpointLatency:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        # Percentiles come from the most recent calls only so memory stays flat
+        self.recent: Deque[float] = deque(maxlen=RECENT_SAMPLES)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        self.calls += 1
+        self.errors += not ok
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def summary(self) -> dict:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg_ms': round(1000 * self.total / max(self.calls, 1), 1),
+            'p50_ms': round(1000 * percentile(self.recent, 50), 1),
+            'p95_ms': round(1000 * percentile(self.recent, 95), 1),
+            'p99_ms': round(1000 * percentile(self.recent, 99), 1),
+        }
+
+ENDPOINT_LATENCY: Dict[str, EndpointLatency] = {}
+
+def latency_summary() -> dict:
+    return {endpoint: latency.summary() for endpoint, latency in sorted(ENDPOINT_LATENCY.items())}
+
+def print_latency_summary() -> None:
+    print(f'Bot API latency: {json.dumps(latency_summary())}')
+
+async def log_latency_summary(interval_minutes: float) -> None:
+    # For polling mode, where there is no webserver to serve the stats endpoint
+    while True:
+        await asyncio.sleep(interval_minutes * 60)
+        print_latency_summary()
+
+class TimedHTTPXRequest(HTTPXRequest):
+    # Records how long every Bot API call takes, keyed by the api method e.g. sendMessage
+    async def do_request(self, url: str, *args, **kwargs) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        ok = False
+        try:
+            code, payload = await super().do_request(url, *args, **kwargs)
+            ok = 200 <= code < 300
+            return code, payload
+        finally:
+            ENDPOINT_LATENCY.setdefault(endpoint, EndpointLatency()).record(time.perf_counter() - start, ok)
+
+def build_request(get_updates: bool=False) -> TimedHTTPXRequest:
+    # getUpdates only ever has one call in flight, everything else shares the bigger pool
+    if get_updates:
+        pool_size = 1
+        read_timeout = get_config('botApiGetUpdatesReadTimeout', 42)
+    else:
+        pool_size = get_config('botApiPoolSize', 256)
+        read_timeout = get_config('botApiReadTimeout', 7)
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=min(get_config('botApiKeepAliveConnections', pool_size), pool_size),
+        keepalive_expiry=get_config('botApiKeepAliveExpiry', 5),
+    )
+    return TimedHTTPXRequest(
+        connection_pool_size=pool_size,
+        read_timeout=read_timeout,
+        write_timeout=get_config('botApiWriteTimeout', 5),
+        connect_timeout=get_config('botApiConnectTimeout', 5),
+        pool_timeout=get_config('botApiPoolTimeout', 1),
+        # Needs h2, pip install "python-telegram-bot[http2]"
+        http_version='2' if get_config('botApiHttp2', False) else '1.1',
+        httpx_kwargs={'limits': limits},
+    )
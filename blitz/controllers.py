@@ -1,32 +1,132 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackContext, Application
+from telegram.ext import CallbackContext, Application, BaseUpdateProcessor
 
-from models import Trips, Trip, Person, Receipt, Logs, State, States
+from models import Trips, Trip, Person, Receipt, Logs, State, States, TripArchives
 from utils import get_config
+from botrequest import build_request
 from pymongo import MongoClient
 from bson import ObjectId
-from typing import List, Optional
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, List, Optional
+import asyncio
+import sys
+import weakref
 
 db = MongoClient(f"mongodb://{get_config('mongoDbHostname')}:{get_config('mongoDbPort')}")['blitz']
 TRIPS = Trips(database=db)
 LOGS = Logs(database=db)
 STATES = States(database=db)
+ARCHIVES = TripArchives(database=db)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Updates run concurrently, but never two from the same chat at once, so a chat sees its updates in order
+    def __init__(self, max_concurrent_updates: int):
+        # PTB takes its semaphore before do_process_update, so it is made unlimited and the real limit
+        # is taken after the chat lock. A busy chat then queues on its own lock instead of holding every slot
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if not isinstance(update, Update) or (update.effective_chat or update.effective_user) is None:
+            async with self.slots:
+                await coroutine
+            return
+        # Poll answers carry no chat, the user is the next best thing to keep in order
+        key = update.effective_chat.id if update.effective_chat else update.effective_user.id
+        lock = self.chat_locks.get(key)
+        if lock is None:
+            lock = self.chat_locks[key] = asyncio.Lock()
+        async with lock:
+            async with self.slots:
+                await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 TOKEN = get_config('token')
-app = (
+MODE = get_config('mode', 'webhook')
+builder = (
     Application.builder()
-    .updater(None)
     .token(TOKEN)
-    .read_timeout(7)
-    .get_updates_read_timeout(42)
-    .build()
+    .base_url(get_config('botApiBaseUrl', 'https://api.telegram.org/bot'))
+    .request(build_request())
+    .get_updates_request(build_request(get_updates=True))
 )
+if MODE == 'polling':
+    builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(get_config('maxConcurrentUpdates', 32)))
+else:
+    builder = builder.updater(None)
+app = builder.build()
 bot = app.bot
 
+def ensure_indexes() -> None:
+    TRIPS.get_collection().create_index([('chat_id', 1), ('last_referenced', -1)])
+    # Idle trips to close, by last_activity or last_referenced for trips from before it was tracked
+    TRIPS.get_collection().create_index([('closed_on', 1), ('last_activity', 1)])
+    TRIPS.get_collection().create_index([('closed_on', 1), ('last_referenced', 1)])
+    # Only the few closed trips waiting on compaction are indexed
+    TRIPS.get_collection().create_index('needs_compaction', partialFilterExpression={'needs_compaction': True})
+    ARCHIVES.get_collection().create_index('trip_id')
+
 def get_last_trip(chat_id: int) -> Optional[Trip|None]:
-    chat_trips = list(TRIPS.find_by({'chat_id': chat_id}))
+    chat_trips = list(TRIPS.find_by({'chat_id': chat_id}, limit=1, sort=[('last_referenced', -1)]))
     if len(chat_trips) < 1: return None
-    return sorted(chat_trips, key=lambda trip: trip.last_referenced)[-1]
+    return chat_trips[0]
+
+def reload_receipts(trip: Trip) -> None:
+    # Brings archived receipts back into memory, the trip in the database stays compact
+    if trip.snapshot is None: return
+    archive = ARCHIVES.find_one_by({'trip_id': str(trip.id)})
+    trip.receipts = archive.load_receipts() if archive else []
+
+# Trips are written with targeted updates so handlers and compaction never overwrite each other's fields
+def update_trip(query: dict, update: dict) -> bool:
+    return TRIPS.get_collection().update_one(query, update).matched_count > 0
+
+def compact_trip(trip: Trip) -> bool:
+    # Archive goes in first so a crash in between never loses receipts
+    archive = trip.compact()
+    ARCHIVES.save(archive)
+    compacted = update_trip(
+        {'_id': trip.id, 'needs_compaction': True},
+        {'$set': {'snapshot': trip.snapshot.model_dump(), 'receipts': [], 'needs_compaction': False}},
+    )
+    if compacted:
+        return True
+    # Another pass got there first
+    ARCHIVES.delete(archive)
+    return False
+
+def compact_trips() -> int:
+    idle_days = get_config('closeIdleTripsAfterDays', None)
+    if idle_days is not None:
+        cutoff = datetime.now() - timedelta(days=idle_days)
+        TRIPS.get_collection().update_many(
+            {'closed_on': None, '$or': [
+                {'last_activity': {'$lt': cutoff}},
+                # Trips from before last_activity was tracked
+                {'last_activity': {'$exists': False}, 'last_referenced': {'$lt': cutoff}},
+            ]},
+            {'$set': {'closed_on': datetime.now(), 'needs_compaction': True}},
+        )
+    compacted = 0
+    for trip in TRIPS.find_by({'needs_compaction': True}):
+        compacted += compact_trip(trip)
+    return compacted
+
+async def compaction_loop() -> None:
+    interval = get_config('compactionIntervalMinutes', 60) * 60
+    while True:
+        try:
+            compacted = await asyncio.to_thread(compact_trips)
+            if compacted: print(f'Compacted {compacted} closed trips')
+        except Exception as e:
+            print(f'Trip compaction failed: {e}')
+        await asyncio.sleep(interval)
 
 async def new_trip(update: Update, context: CallbackContext) -> None:
     m = update.message
@@ -49,10 +149,18 @@ async def join_trip(update: Update, context: CallbackContext) -> None:
     # Returns the list of registered users
     q = update.callback_query
     trip: Trip = TRIPS.find_one_by_id(ObjectId(q.data.replace('trip_join', '')))
+    if trip.is_closed():
+        await q.answer('This trip has been closed')
+        return
     person = Person(user_id=q.from_user.id, user_name=q.from_user.username)
     if not trip.add_person(person):
         return
-    TRIPS.save(trip)
+    joined = update_trip(
+        {'_id': trip.id, 'closed_on': None, 'attendees.user_id': {'$ne': person.user_id}},
+        {'$push': {'attendees': person.model_dump()}, '$set': {'last_activity': datetime.now()}},
+    )
+    if not joined:
+        return
     await bot.edit_message_text(
         trip.describe(),
         q.message.chat.id,
@@ -79,10 +187,17 @@ async def change_trip(update: Update, context: CallbackContext) -> None:
     PAGE_SIZE = 9
     if sub_option.startswith('show'):
         page = int(sub_option.replace('show', ''))
-        all_trips = sorted(list(TRIPS.find_by({"chat_id": q.message.chat.id})), key=lambda trip: trip.last_referenced, reverse=True)
         start_idx = page * PAGE_SIZE
-        section = all_trips[start_idx:start_idx+PAGE_SIZE]
-        next_page_exists = start_idx + PAGE_SIZE < len(all_trips)
+        # One extra to know if there is a next page, receipts are not needed for the buttons
+        section = list(TRIPS.find_by(
+            {"chat_id": q.message.chat.id},
+            skip=start_idx,
+            limit=PAGE_SIZE+1,
+            projection={'receipts': 0},
+            sort=[('last_referenced', -1)],
+        ))
+        next_page_exists = len(section) > PAGE_SIZE
+        section = section[:PAGE_SIZE]
         await q.edit_message_reply_markup(InlineKeyboardMarkup(
             [
                 [InlineKeyboardButton(f'{trip.title} ({trip.created_on.strftime("%b %y")})', callback_data=f'trip_browse_select{trip.id}')]
@@ -94,7 +209,7 @@ async def change_trip(update: Update, context: CallbackContext) -> None:
         oid = ObjectId(sub_option.replace('select', ''))
         trip = TRIPS.find_one_by_id(oid)
         trip.update_as_last_referenced()
-        TRIPS.save(trip)
+        update_trip({'_id': oid}, {'$set': {'last_referenced': trip.last_referenced, 'last_activity': trip.last_referenced}})
         await q.edit_message_text(
             trip.describe(),
             reply_markup=InlineKeyboardMarkup([
@@ -120,6 +235,9 @@ async def new_receipt(update: Update, context: CallbackContext) -> None:
     if last_trip is None:
         await update.message.reply_text('There is no recent trip found in the database')
         return
+    if last_trip.is_closed():
+        await update.message.reply_text(f'{last_trip.title} has been closed, start a new trip with /trip TRIP_NAME')
+        return
     options = [(p.user_id, p.user_name) for p in last_trip.attendees]
     poll_text = '\n'.join([
         f'Trip: {last_trip.title}',
@@ -151,8 +269,8 @@ async def new_receipt(update: Update, context: CallbackContext) -> None:
 async def complete_receipt(update: Update, context: CallbackContext):
     poll = update.poll_answer
     state = STATES.find_one_by({'data.poll_id': poll.poll_id})
-    if state.data['type'] != 'receipt': return
-    trip = TRIPS.find_one_by_id(ObjectId(state.data['trip_id']))
+    # Polls from before the state expired, or not created by a receipt
+    if state is None or state.data['type'] != 'receipt': return
     if 0 in poll.option_ids: # Everyone
         paid_for = [Person(user_id=uid, user_name=username) for uid, username in state.data['options']]
     elif 1 in poll.option_ids: # Everyone except...
@@ -162,32 +280,61 @@ async def complete_receipt(update: Update, context: CallbackContext):
     else:
         to_add = [state.data['options'][opt_no-2] for opt_no in poll.option_ids]
         paid_for = [Person(user_id=uid, user_name=username) for uid, username in to_add]
-    trip.receipts.append(Receipt(
+    receipt = Receipt(
         paid_by=Person(user_id=state.data['paid_by'][0], user_name=state.data['paid_by'][1]),
         paid_for=paid_for,
         amount=state.data['amount'],
         description=state.data['description'],
-    ))
-    TRIPS.save(trip)
+    )
+    # Dropped if the trip was closed while the poll was open
+    update_trip(
+        {'_id': ObjectId(state.data['trip_id']), 'closed_on': None},
+        {'$push': {'receipts': receipt.model_dump()}, '$set': {'last_activity': datetime.now()}},
+    )
     await bot.stop_poll(state.data['chat_id'], state.data['message_id'])
 
 async def settle(update: Update, context: CallbackContext) -> None:
-    chat_trips = list(TRIPS.find_by({'chat_id': update.message.chat.id}))
-    if len(chat_trips) < 1:
+    last_trip = get_last_trip(update.message.chat.id)
+    if last_trip is None:
         await update.message.reply_text('There is no recent trip found in the database')
         return
-    last_trip = sorted(chat_trips, key=lambda trip: trip.last_referenced)[-1]
     await update.message.reply_text(last_trip.describe_settle())
 
+async def close_trip(update: Update, context: CallbackContext) -> None:
+    trip = get_last_trip(update.message.chat.id)
+    if trip is None:
+        await update.message.reply_text('There is no recent trip found in the database')
+        return
+    trip.close()
+    if not update_trip({'_id': trip.id, 'closed_on': None}, {'$set': {'closed_on': trip.closed_on, 'needs_compaction': True}}):
+        await update.message.reply_text(f'{trip.title} is already closed')
+        return
+    await update.message.chat.send_message(f'Closed {trip.title}, no more receipts can be added\n\n' + trip.describe_settle())
+
 async def show_receipts(update: Update, context: CallbackContext):
     trip = get_last_trip(update.message.chat.id)
+    if trip is None:
+        await update.message.reply_text('There is no recent trip found in the database')
+        return
+    reload_receipts(trip)
     await update.message.chat.send_message(trip.show_receipts())
 
 async def multiply(update: Update, context: CallbackContext):
     trip = get_last_trip(update.message.chat.id)
+    if trip.is_closed():
+        await update.message.reply_text(f'{trip.title} has been closed, its receipts cant be changed')
+        return
     for receipt in trip.receipts:
         receipt.multiply(context.user_data['rate'])
-    TRIPS.save(trip)
+    # Only the amounts seen here are set, receipts pushed in the meantime are left alone
+    amounts = {f'receipts.{idx}.amount': receipt.amount for idx, receipt in enumerate(trip.receipts)}
+    multiplied = update_trip(
+        {'_id': trip.id, 'closed_on': None},
+        {'$set': amounts | {'last_activity': datetime.now()}},
+    )
+    if not multiplied:
+        await update.message.reply_text(f'{trip.title} has been closed, its receipts cant be changed')
+        return
     await update.message.chat.send_message(f'Successfully multiplied all receipts by {context.user_data["rate"]:.4}\n\n' + trip.show_receipts())
 
 async def explain(update: Update, context: CallbackContext):
@@ -0,0 +1,367 @@
+'''
+Load test harness for the webhook endpoint
+
+Three pieces, each run from the repo root in its own terminal:
+
+python blitz/loadtest.py fake-api --port 8081
+    Stand-in for the Telegram Bot API. Point the bot at it with
+    "botApiBaseUrl": "http://127.0.0.1:8081/bot" in config.json
+
+python blitz/loadtest.py serve [--in-memory-mongo] [--debug]
+    Runs main.webserver with handler errors counted per update type, without registering
+    the webhook so no certfile is needed. With --in-memory-mongo
+    the trips live in mongomock (pip install mongomock), otherwise the configured mongo is used.
+    Updates are only printed with --debug, printing them skews the latencies
+
+python blitz/loadtest.py run --target http://127.0.0.1:6000 --rate 50 --concurrency 20 --count 2000
+    Fires synthetic updates (or --updates recorded.jsonl, one Update per line)
+    at the webhook and reports throughput, latency percentiles and errors per update type.
+    Synthetic poll answers answer polls the bot sent through --fake-api
+'''
+from utils import get_config
+from botrequest import percentile
+
+from fastapi import FastAPI, Request
+from telegram import Update
+from telegram.ext import CallbackContext
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional
+from urllib.parse import parse_qs
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import httpx
+import uvicorn
+
+# ----- Fake Bot API -----
+
+fake_api = FastAPI()
+FAKE_API_LATENCY = 0.0
+FAKE_BOT = {'id': 1, 'is_bot': True, 'first_name': 'Blitz', 'username': 'blitz_loadtest_bot'}
+message_ids = itertools.count(1)
+poll_ids = itertools.count(1)
+# Polls sent by the bot that nobody has answered yet, handed out to the load generator
+OPEN_POLLS: Deque[dict] = deque(maxlen=10000)
+
+def fake_message(params: dict) -> dict:
+    return {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': int(params.get('chat_id', 0)), 'type': 'group', 'title': 'Load Test'},
+        'from': FAKE_BOT,
+        'text': params.get('text', ''),
+    }
+
+def fake_poll(params: dict, is_closed: bool=False) -> dict:
+    options = json.loads(params.get('options', '[]'))
+    return {
+        'id': str(next(poll_ids)),
+        'question': params.get('question', ''),
+        'options': [{'text': opt if isinstance(opt, str) else opt.get('text', ''), 'voter_count': 0} for opt in options],
+        'total_voter_count': 0,
+        'is_closed': is_closed,
+        'is_anonymous': False,
+        'type': 'regular',
+        'allows_multiple_answers': True,
+    }
+
+async def read_params(request: Request) -> dict:
+    body = await request.body()
+    if not body:
+        return {}
+    if request.headers.get('content-type', '').startswith('application/json'):
+        return json.loads(body)
+    return {k: v[-1] for k, v in parse_qs(body.decode()).items()}
+
+@fake_api.post('/bot{token}/{method}')
+async def fake_method(token: str, method: str, request: Request) -> dict:
+    params = await read_params(request)
+    if FAKE_API_LATENCY:
+        await asyncio.sleep(FAKE_API_LATENCY)
+    if method == 'getMe':
+        result = FAKE_BOT
+    elif method == 'getUpdates':
+        # Nothing to deliver, behave like an idle long poll
+        await asyncio.sleep(min(float(params.get('timeout', 0)), 1.0))
+        result = []
+    elif method == 'sendPoll':
+        result = fake_message(params) | {'poll': fake_poll(params)}
+        OPEN_POLLS.append({'poll_id': result['poll']['id'], 'chat_id': result['chat']['id']})
+    elif method == 'stopPoll':
+        result = fake_poll(params, is_closed=True)
+    elif method.startswith('send') or method.startswith('edit'):
+        result = fake_message(params)
+    else:
+        result = True
+    return {'ok': True, 'result': result}
+
+@fake_api.post('/polls/take')
+async def take_open_polls() -> List[dict]:
+    polls = list(OPEN_POLLS)
+    OPEN_POLLS.clear()
+    return polls
+
+# ----- Synthetic updates -----
+
+SYNTHETIC_TEXT = {
+    'command': ['/show', '/settle', '/receipts', '/help', '/multiply 1'],
+    'text': ['hey blitz settle up', 'hey blitz show me the receipts', 'hey blitz I paid 12.50 for lunch', 'lol nice'],
+}
+DEFAULT_MIX = {'command': 4, 'text': 3, 'callback_query': 2, 'poll_answer': 1}
+update_ids = itertools.count(1)
+
+def make_user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+def make_chat(chat_id: int) -> dict:
+    return {'id': -chat_id, 'type': 'group', 'title': f'Load Test {chat_id}'}
+
+def make_message(chat_id: int, user_id: int, text: str) -> dict:
+    message = {
+        'message_id': random.randint(1, 2**31),
+        'date': int(time.time()),
+        'chat': make_chat(chat_id),
+        'from': make_user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return message
+
+def make_update(kind: str, chat_id: int, user_id: int, poll: Optional[dict]=None) -> dict:
+    update = {'update_id': next(update_ids)}
+    if kind in SYNTHETIC_TEXT:
+        update['message'] = make_message(chat_id, user_id, random.choice(SYNTHETIC_TEXT[kind]))
+    elif kind == 'callback_query':
+        update['callback_query'] = {
+            'id': str(update['update_id']),
+            'from': make_user(user_id),
+            'chat_instance': str(chat_id),
+            'data': 'trip_browse_show0',
+            'message': make_message(chat_id, FAKE_BOT['id'], 'Load Test'),
+        }
+    elif kind == 'poll_answer':
+        # Everyone, so the receipt gets recorded and the poll stopped
+        update['poll_answer'] = {'poll_id': poll['poll_id'], 'user': make_user(user_id), 'option_ids': [0]}
+    else:
+        raise ValueError(f'Unknown update type {kind}')
+    return update
+
+def synthetic_updates(mix: Dict[str, int], chats: int, users_per_chat: int, open_polls: List[dict]) -> Iterator[dict]:
+    kinds, weights = list(mix.keys()), list(mix.values())
+    while True:
+        kind = random.choices(kinds, weights)[0]
+        if kind == 'poll_answer' and not open_polls:
+            # No poll to answer yet, open one with a bill instead
+            chat_id = random.randint(1, chats)
+            user_id = chat_id * 1000 + random.randint(1, users_per_chat)
+            yield {'update_id': next(update_ids), 'message': make_message(chat_id, user_id, 'hey blitz I paid 12.50 for lunch')}
+            continue
+        poll = open_polls.pop(0) if kind == 'poll_answer' else None
+        chat_id = -poll['chat_id'] if poll else random.randint(1, chats)
+        user_id = chat_id * 1000 + random.randint(1, users_per_chat)
+        yield make_update(kind, chat_id, user_id, poll)
+
+async def collect_open_polls(fake_api_url: str, open_polls: List[dict]) -> None:
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                res = await client.post(fake_api_url.rstrip('/') + '/polls/take')
+                open_polls.extend(res.json())
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+
+def seed_updates(chats: int) -> List[dict]:
+    # Every chat gets a trip so the handlers do real work instead of replying 'no trip found'
+    return [{'update_id': next(update_ids), 'message': make_message(chat_id, chat_id * 1000 + 1, '/trip Load Test')} for chat_id in range(1, chats + 1)]
+
+def recorded_updates(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def update_type(update: dict) -> str:
+    message = update.get('message') or update.get('edited_message')
+    if message is not None:
+        text = message.get('text', '')
+        if text.startswith('/'):
+            return f'command {text.split()[0].split("@")[0]}'
+        return 'text'
+    for kind in ('callback_query', 'poll_answer', 'poll'):
+        if kind in update:
+            return kind
+    return 'other'
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    parsed = {}
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        parsed[kind.strip()] = int(weight)
+    return parsed
+
+# ----- Handler errors, counted by the serve process -----
+
+# Handlers failing still answer the webhook with 200, so the client cant see these
+HANDLER_ERRORS: Dict[str, int] = {}
+HANDLER_ERRORS_ROUTE = '/webhook/loadtest/errors'
+
+async def count_handler_error(update: object, context: CallbackContext) -> None:
+    kind = update_type(update.to_dict()) if isinstance(update, Update) else 'other'
+    HANDLER_ERRORS[kind] = HANDLER_ERRORS.get(kind, 0) + 1
+
+async def handler_errors() -> Dict[str, int]:
+    return HANDLER_ERRORS
+
+async def fetch_handler_errors(target: str) -> Optional[Dict[str, int]]:
+    try:
+        async with httpx.AsyncClient() as client:
+            res = await client.get(target.rstrip('/') + HANDLER_ERRORS_ROUTE)
+    except httpx.HTTPError:
+        return None
+    return res.json() if res.status_code == 200 else None
+
+# ----- Load generation -----
+
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.handler_errors = 0
+
+async def send_update(client: httpx.AsyncClient, url: str, update: dict) -> bool:
+    try:
+        res = await client.post(url, json=update)
+        return res.status_code == 200
+    except httpx.HTTPError:
+        return False
+
+async def run_load(url: str, updates: Iterator[dict], count: int, rate: float, concurrency: int, timeout: float) -> Dict[str, Stats]:
+    stats: Dict[str, Stats] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fire(client: httpx.AsyncClient, update: dict, scheduled: float) -> None:
+        async with semaphore:
+            ok = await send_update(client, url, update)
+        # Measured from the scheduled send time so a saturated server cant hide queueing delay
+        kind_stats = stats.setdefault(update_type(update), Stats())
+        kind_stats.latencies.append(time.perf_counter() - scheduled)
+        if not ok:
+            kind_stats.errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        start = time.perf_counter()
+        tasks = []
+        for i, update in enumerate(itertools.islice(updates, count)):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(fire(client, update, scheduled)))
+        await asyncio.gather(*tasks)
+    return stats
+
+def report(stats: Dict[str, Stats], elapsed: float, handler_errors_known: bool) -> str:
+    total = Stats()
+    for kind_stats in stats.values():
+        total.latencies.extend(kind_stats.latencies)
+        total.errors += kind_stats.errors
+        total.handler_errors += kind_stats.handler_errors
+    lines = [f'{"update type":<24}{"count":>8}{"http err":>10}{"handler err":>13}{"err %":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}']
+    for kind, kind_stats in sorted(stats.items()) + [('TOTAL', total)]:
+        count = len(kind_stats.latencies)
+        errors = kind_stats.errors + kind_stats.handler_errors
+        lines.append(
+            f'{kind:<24}{count:>8}{kind_stats.errors:>10}{kind_stats.handler_errors if handler_errors_known else "n/a":>13}'
+            f'{100 * errors / max(count, 1):>8.1f}'
+            f'{1000 * percentile(kind_stats.latencies, 50):>10.1f}{1000 * percentile(kind_stats.latencies, 95):>10.1f}'
+            f'{1000 * percentile(kind_stats.latencies, 99):>10.1f}'
+        )
+    lines.append(f'\n{len(total.latencies)} updates in {elapsed:.2f}s, {len(total.latencies) / elapsed:.1f} updates/s')
+    if not handler_errors_known:
+        lines.append('Handler errors are only counted when the target is run with loadtest.py serve')
+    return '\n'.join(lines)
+
+async def run(args: argparse.Namespace) -> None:
+    url = args.target.rstrip('/') + get_config('endpoint')
+    if args.updates:
+        recorded = recorded_updates(args.updates)
+        count = args.count or len(recorded)
+        updates = itertools.cycle(recorded)
+    else:
+        count = args.count or 1000
+        open_polls: List[dict] = []
+        poll_collector = asyncio.create_task(collect_open_polls(args.fake_api, open_polls))
+        updates = synthetic_updates(parse_mix(args.mix), args.chats, args.users, open_polls)
+        if not args.no_seed:
+            seeding = seed_updates(args.chats)
+            await run_load(url, iter(seeding), len(seeding), args.rate, args.concurrency, args.timeout)
+    errors_before = await fetch_handler_errors(args.target)
+    start = time.perf_counter()
+    stats = await run_load(url, updates, count, args.rate, args.concurrency, args.timeout)
+    elapsed = time.perf_counter() - start
+    errors_after = await fetch_handler_errors(args.target)
+    handler_errors_known = errors_before is not None and errors_after is not None
+    if handler_errors_known:
+        for kind, errors in errors_after.items():
+            stats.setdefault(kind, Stats()).handler_errors = errors - errors_before.get(kind, 0)
+    if not args.updates:
+        poll_collector.cancel()
+    print(report(stats, elapsed, handler_errors_known))
+
+def serve(args: argparse.Namespace) -> None:
+    if args.in_memory_mongo:
+        import mongomock
+        import pymongo
+        # Has to happen before controllers creates its client
+        pymongo.MongoClient = mongomock.MongoClient
+    import main
+    main.blitzApp.DEBUG_MODE = args.debug
+    main.blitzApp.REGISTER_WEBHOOK = False
+    main.blitzApp.bot.add_error_handler(count_handler_error)
+    main.webserver.add_api_route(HANDLER_ERRORS_ROUTE, handler_errors, methods=['GET'])
+    uvicorn.run(main.webserver, host=args.host, port=args.port or get_config('port'))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load test the blitz webhook')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fake_api_parser = subparsers.add_parser('fake-api', help='Run a stand-in Telegram Bot API')
+    fake_api_parser.add_argument('--host', default='127.0.0.1')
+    fake_api_parser.add_argument('--port', type=int, default=8081)
+    fake_api_parser.add_argument('--latency-ms', type=float, default=0, help='Added to every Bot API call')
+
+    serve_parser = subparsers.add_parser('serve', help='Run the webhook server for load testing')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=None)
+    serve_parser.add_argument('--in-memory-mongo', action='store_true', help='Use mongomock instead of the configured mongo')
+    serve_parser.add_argument('--debug', action='store_true', help='Print every update like DEBUG_MODE does')
+
+    run_parser = subparsers.add_parser('run', help='Fire updates at the webhook and report latencies')
+    run_parser.add_argument('--target', default=f'http://127.0.0.1:{get_config("port")}')
+    run_parser.add_argument('--fake-api', default='http://127.0.0.1:8081', help='Fake Bot API to take sent polls from')
+    run_parser.add_argument('--updates', help='File with one recorded Update JSON per line')
+    run_parser.add_argument('--count', type=int, default=None, help='Updates to send, defaults to 1000 or the whole recording')
+    run_parser.add_argument('--rate', type=float, default=50, help='Updates per second')
+    run_parser.add_argument('--concurrency', type=int, default=20, help='Max in-flight requests')
+    run_parser.add_argument('--timeout', type=float, default=30)
+    run_parser.add_argument('--mix', default=','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items()), help='Weights of synthetic update types')
+    run_parser.add_argument('--chats', type=int, default=20)
+    run_parser.add_argument('--users', type=int, default=5, help='Users per chat')
+    run_parser.add_argument('--no-seed', action='store_true', help='Skip creating a trip in every chat first')
+
+    args = parser.parse_args()
+    if args.command == 'fake-api':
+        global FAKE_API_LATENCY
+        FAKE_API_LATENCY = args.latency_ms / 1000
+        uvicorn.run(fake_api, host=args.host, port=args.port)
+    elif args.command == 'serve':
+        serve(args)
+    else:
+        asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
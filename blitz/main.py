@@ -1,9 +1,12 @@
 import blitzApp as blitzApp
+import botrequest
 from utils import get_config
 
 from contextlib import asynccontextmanager
 from http import HTTPStatus
 from fastapi import FastAPI, Request, Response
+from telegram import Update
+import asyncio
 import uvicorn
 
 '''
@@ -11,6 +14,7 @@ Every app in APPS must have
 bot: Application
 endpoint: str
 async def setup() -> None
+async def shutdown() -> None
 async def process_request() -> Response
 '''
 APPS = [blitzApp]
@@ -23,6 +27,7 @@ async def lifespan(_: FastAPI):
             await app.bot.start()
             yield
             await app.bot.stop()
+        await app.shutdown()
 
 # Initialize FastAPI app (similar to Flask)
 webserver = FastAPI(lifespan=lifespan)
@@ -33,14 +38,45 @@ async def test_webapp(request: Request) -> Response:
     # https://localhost:80/test
     return Response("All is good!", status_code=HTTPStatus.OK)
 
+async def bot_api_stats(request: Request) -> dict:
+    # Latency of outgoing Bot API calls per method since startup
+    return botrequest.latency_summary()
+
+# Off unless configured, keep it on a path the public proxy does not forward
+if get_config('statsEndpoint', None):
+    webserver.add_api_route(get_config('statsEndpoint'), bot_api_stats, methods=['GET'])
+
 for app in APPS:
     async def process_request(request: Request):
         return await app.process_request(request)
     webserver.add_api_route(app.endpoint, process_request, methods=['POST'])
 
+async def poll() -> None:
+    # Long polls getUpdates instead of serving the webhook, each batch is processed concurrently
+    stats_task = asyncio.create_task(botrequest.log_latency_summary(get_config('botApiStatsIntervalMinutes', 15)))
+    for app in APPS:
+        await app.setup()
+        async with app.bot:
+            await app.bot.updater.start_polling(
+                timeout=get_config('pollingTimeout', 30),
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await app.bot.start()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                stats_task.cancel()
+                botrequest.print_latency_summary()
+                await app.bot.updater.stop()
+                await app.bot.stop()
+                await app.shutdown()
+
 if __name__ == '__main__':
-    uvicorn.run(
-        "main:webserver",
-        host='0.0.0.0',
-        port=get_config("port"),
-    )
+    if get_config('mode', 'webhook') == 'polling':
+        asyncio.run(poll())
+    else:
+        uvicorn.run(
+            "main:webserver",
+            host='0.0.0.0',
+            port=get_config("port"),
+        )
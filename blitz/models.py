@@ -2,6 +2,8 @@ from pydantic_mongo import AbstractRepository, PydanticObjectId
 from pydantic import BaseModel, Field
 from typing import Optional, List, Self
 from datetime import datetime, timedelta
+import json
+import zlib
 
 class Person(BaseModel):
     user_id: int
@@ -70,6 +72,11 @@ class Receipt(BaseModel):
     def multiply(self, amount: float) -> None:
         self.amount *= amount
 
+class TripSnapshot(BaseModel):
+    balances: List[IOU]
+    total_amount: float
+    receipt_count: int
+
 class Trip(BaseModel):
     id: Optional[PydanticObjectId] = None
     chat_name: str = ""
@@ -78,8 +85,38 @@ class Trip(BaseModel):
     created_by: Person
     created_on: datetime = Field(default_factory=datetime.now)
     last_referenced: datetime = Field(default_factory=datetime.now)
+    # Bumped whenever the trip is used, decides when an idle trip gets closed
+    last_activity: datetime = Field(default_factory=datetime.now)
     attendees: List[Person]
     receipts: List[Receipt] = []
+    closed_on: Optional[datetime] = None
+    # Closed but the receipts are still in the trip
+    needs_compaction: bool = False
+    # Set once the receipts have been moved to the archive
+    snapshot: Optional[TripSnapshot] = None
+
+    def is_closed(self) -> bool:
+        return self.closed_on is not None
+
+    def receipt_count(self) -> int:
+        if self.snapshot is not None:
+            return self.snapshot.receipt_count
+        return len(self.receipts)
+
+    def close(self) -> None:
+        self.closed_on = datetime.now()
+        self.needs_compaction = True
+
+    def compact(self) -> 'TripArchive':
+        archive = TripArchive.from_receipts(self.id, self.chat_id, self.receipts)
+        self.snapshot = TripSnapshot(
+            balances=self.settle(),
+            total_amount=sum(receipt.amount for receipt in self.receipts),
+            receipt_count=len(self.receipts),
+        )
+        self.receipts = []
+        self.needs_compaction = False
+        return archive
 
     def get_ious(self) -> List[IOU]:
         ious: List[IOU] = []
@@ -88,6 +125,8 @@ class Trip(BaseModel):
         return ious
 
     def settle(self) -> List[IOU]:
+        if self.snapshot is not None:
+            return [iou.model_copy(deep=True) for iou in self.snapshot.balances]
         ious = self.get_ious()
         settled_ious: List[IOU] = []
         for iou in ious:
@@ -103,8 +142,11 @@ class Trip(BaseModel):
         ious = self.settle()
         lines = [
             f'🎉 {self.title} 🎉\n',
-            f'Receipts: {len(self.receipts)}\n',
+            f'Receipts: {self.receipt_count()}\n',
         ]
+        if not ious:
+            lines.append('Everyone is square!')
+            return '\n'.join(lines)
         ious.sort(key=lambda iou: iou.paid_for.user_name)
         curr_oweing = ious[0].paid_for
         for iou in ious:
@@ -120,13 +162,13 @@ class Trip(BaseModel):
             f'🎉 {self.title} 🎉',
             f'< {self.created_on.strftime("%d %b %Y")} >',
             '',
-            f'Receipts: {len(self.receipts)}',
+            f'Receipts: {self.receipt_count()}',
             f'Attendees:\n{attendees_str}',
         ]
         return '\n'.join(lines)
     
     def one_liner(self) -> str:
-        return f'{self.title} with {self.chat_name}\n{len(self.attendees)} people, {len(self.receipts)} receipts'
+        return f'{self.title} with {self.chat_name}\n{len(self.attendees)} people, {self.receipt_count()} receipts'
 
     def add_person(self, p: Person) -> bool:
         attendees = set(self.attendees)
@@ -147,6 +189,26 @@ class Trips(AbstractRepository[Trip]):
     class Meta:
         collection_name = 'trips'
 
+class TripArchive(BaseModel):
+    id: Optional[PydanticObjectId] = None
+    trip_id: str
+    chat_id: int
+    archived_on: datetime = Field(default_factory=datetime.now)
+    # zlib compressed JSON list of receipts
+    receipts: bytes
+
+    @classmethod
+    def from_receipts(cls, trip_id: PydanticObjectId, chat_id: int, receipts: List[Receipt]) -> Self:
+        raw = json.dumps([receipt.model_dump() for receipt in receipts]).encode()
+        return cls(trip_id=str(trip_id), chat_id=chat_id, receipts=zlib.compress(raw))
+
+    def load_receipts(self) -> List[Receipt]:
+        return [Receipt(**receipt) for receipt in json.loads(zlib.decompress(self.receipts))]
+
+class TripArchives(AbstractRepository[TripArchive]):
+    class Meta:
+        collection_name = 'trip_archives'
+
 def generate_expiry_date() -> datetime:
     return datetime.now() + timedelta(days=30)
 
@@ -6,7 +6,10 @@ config_file = "./blitz/config.json"
 with open(config_file) as f:
     data = json.load(f)
 
+_REQUIRED = object()
+
 @cache
-def get_config(kw: str=None):
+def get_config(kw: str=None, default=_REQUIRED):
     if not kw: return data
-    return data[kw]
+    if default is _REQUIRED: return data[kw]
+    return data.get(kw, default)